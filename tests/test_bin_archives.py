@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" Test for dji-firmware-tools, known archives extraction check.
+
+    This test prepares files for deeper verification by extracting
+    any archives included within previously extracted modules.
+
+    This test works on modules previously extracted from firmware
+    packages into the `out` directory, either by the shell test
+    scripts or by manual invocation of the extraction tools.
+
+    An example invocation:
+
+    # unpack archives included in already extracted firmware modules
+    python3 -m pytest tests/test_bin_archives.py -o log_cli=true
+
+"""
+
+# Copyright (C) 2018 Mefistotelis <mefistotelis@gmail.com>
+# Copyright (C) 2018 Original Gangsters <https://dji-rev.slack.com/>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+__version__ = "0.0.1"
+__author__ = "Mefistotelis @ Original Gangsters"
+__license__ = "GPL"
+
+import functools
+import hashlib
+import logging
+import os
+import re
+import subprocess
+import tarfile
+import zipfile
+
+import pytest
+from Crypto.Cipher import DES3
+
+LOGGER = logging.getLogger(__name__)
+
+# Stream copies move this much per syscall; small buffers would dominate
+# the cost of pushing decrypted archives around
+BUFSIZE = 1 << 20
+
+# Patterns are compiled once here - the functions below run for every module
+# file, and recompiling them each call adds up across the test matrix
+
+_RE_MODL_SUFFIX = re.compile(r'^(.*)_m?([0-9]{4})[.]bin$', re.IGNORECASE)
+
+# Modules in formats known to be unsupported - unreadable encryption or
+# signature; a single alternation is matched once per module file
+_RE_IGNORE_UNKNOWN = re.compile(
+    r'^(?:wm100[a]?_(?:0801|0905)'
+    r'|wm620_(?:0801|0802|0905)'
+    r'|wm335_(?:0801|0802|0805|1301)'
+    r'|wm260[5]?_0802'
+    r'|ag600_2403_v06[.]00[.]01[.]10)[._].*$', re.IGNORECASE)
+
+# Modules which hold direct ARM firmware binaries rather than archives
+_RE_NOARCH_XV4_M0100 = re.compile(r'^.*(A3|MATRICE600|MATRICE600PRO)_FW_.*_m0100[.]bin$', re.IGNORECASE)
+_RE_NOARCH_XV4_M0801 = re.compile(r'^.*(MG1S|WM610|WM610_FC550)_FW_.*_m0801[.]bin$', re.IGNORECASE)
+_RE_NOARCH_V1_WM100 = re.compile(r'^.*(wm100)[a]?_(0100|0101)[._].*[.]bin$', re.IGNORECASE)
+_RE_NOARCH_V1_WM220 = re.compile(r'^.*(wm220|wm330)_(0100)[._].*[.]bin$', re.IGNORECASE)
+_RE_NOARCH_V2_WM160 = re.compile(r'^.*(wm160|wm161)_(0100|0101)[._].*[.]bin$', re.IGNORECASE)
+_RE_NOARCH_V2_WM230 = re.compile(r'^.*(wm230|wm240|wm245)_(0100)[._].*[.]bin$', re.IGNORECASE)
+
+# Exclusion lists for the post-glob filters, one per test variant
+_EXCLUDE_XV4 = [_RE_NOARCH_XV4_M0100, _RE_NOARCH_XV4_M0801]
+_EXCLUDE_V1 = [_RE_NOARCH_V1_WM100, _RE_NOARCH_V1_WM220]
+_EXCLUDE_V2 = [_RE_NOARCH_V2_WM160, _RE_NOARCH_V2_WM230]
+
+
+@functools.lru_cache(maxsize=None)
+def is_openssl_file(inp_fn):
+    """ Identify if the file is an OpenSSL encryption envelope.
+
+        Results are cached - the probed files are not modified during a
+        test run, and the same file can be probed by several tests.
+    """
+    with open(inp_fn, 'rb') as encfh:
+        return encfh.read(8) == b'Salted__'
+
+
+def openssl_des3_decrypt_stream(inp_fn, passwd=b"Dji123456"):
+    """ Decrypt an OpenSSL `Salted__` des3 envelope, like `openssl des3 -md md5 -d` would.
+
+        Doing this in-process avoids the fork/exec cost of the openssl binary
+        and a second read of the ciphertext from disk. Yields plaintext
+        chunks, so the output can be piped onward without touching disk.
+    """
+    with open(inp_fn, 'rb') as encfh:
+        magic = encfh.read(8)
+        assert magic == b'Salted__', "OpenSSL salt magic not found in file: {:s}".format(inp_fn)
+        salt = encfh.read(8)
+        # EVP_BytesToKey with MD5, one iteration - 24-byte key plus 8-byte IV
+        keyiv = b''
+        md = b''
+        while len(keyiv) < 24 + 8:
+            md = hashlib.md5(md + passwd + salt).digest()
+            keyiv += md
+        cipher = DES3.new(keyiv[:24], DES3.MODE_CBC, keyiv[24:32])
+        chunk = encfh.read(BUFSIZE)
+        while len(chunk) > 0:
+            nextchunk = encfh.read(BUFSIZE)
+            plain = cipher.decrypt(chunk)
+            if len(nextchunk) < 1:
+                # PKCS#7 padding fills the last block
+                plain = plain[:-plain[-1]]
+            yield plain
+            chunk = nextchunk
+
+
+@functools.lru_cache(maxsize=None)
+def is_module_unsigned_encrypted(modl_inp_fn):
+    """ Identify if the module was extracted without full decryption.
+        If the module data is encrypted, invoking extraction on it makes no sense.
+
+        Results are cached - sibling modules share one INI, and the files are
+        not modified during a test run.
+    """
+    match = _RE_MODL_SUFFIX.search(modl_inp_fn)
+    if not match:
+        return False
+    modl_part_fn = match.group(1)
+    modl_ini_fn = f"{modl_part_fn}_head.ini"
+    try:
+        # the INI is at most a few KiB - a plain read beats mmap setup cost
+        with open(modl_ini_fn, 'rb') as inifh:
+            return inifh.read().find(b"scramble_key_encrypted") != -1
+    except Exception as e:
+        LOGGER.info("Could not check INI of module file: {}".format(e))
+        return False
+
+
+def detect_archive_format(head):
+    """ Classify archive type from the first 512 bytes of content.
+
+        Cheaper than tarfile.is_tarfile, which parses and checksums a whole
+        header, and zipfile.is_zipfile, which seeks to EOF for the central
+        directory; garbage input is rejected by a few byte compares.
+    """
+    if head[:2] == b'\x1f\x8b':
+        return 'tgz'
+    if head[257:265] in (b'ustar\x0000', b'ustar  \x00'):
+        return 'tar'
+    if head[:4] == b'PK\x03\x04':
+        return 'zip'
+    return None
+
+
+def tar_extractall_overwrite(tarfh, path='.'):
+    """ Extract all members from the tar archive, overwriting existing files.
+    """
+    for f in tarfh:
+        target = os.path.join(path, f.name)
+        if f.isreg() and os.path.exists(target):
+            # unlinking upfront is cheaper than failing and extracting twice
+            os.chmod(target, 0o644)
+            os.unlink(target)
+        tarfh.extract(f, path, set_attrs=False, numeric_owner=False)
+    pass
+
+
+def case_bin_archive_extract(modl_inp_fn):
+    """ Test case for extraction of archives, and prepare data for tests which use the extracted files.
+    """
+    LOGGER.info("Testcase file: {:s}".format(modl_inp_fn))
+
+    inp_path, inp_filename = os.path.split(modl_inp_fn)
+    inp_basename, modl_fileext = os.path.splitext(inp_filename)
+    out_path = inp_path
+    modules_path1 = os.path.join(out_path, f"{inp_basename}-extr1")
+    os.makedirs(modules_path1, exist_ok=True)
+
+    ignore_unknown_format = bool(_RE_IGNORE_UNKNOWN.match(inp_basename))
+
+    # Determine if this is an openssl encrypted file, and decrypt it first
+    if is_openssl_file(modl_inp_fn):
+        # Decrypt as a stream - a tar archive can be piped straight into
+        # extraction, halving disk traffic versus a plaintext intermediate
+        plain_chunks = openssl_des3_decrypt_stream(modl_inp_fn)
+        head = next(plain_chunks, b'')
+        arch_format = detect_archive_format(head)
+        if arch_format in ('tar', 'tgz'):
+            command = ["tar", "-xzf" if arch_format == 'tgz' else "-xf", "-", "-C", modules_path1, "--overwrite"]
+            if LOGGER.isEnabledFor(logging.INFO):
+                LOGGER.info(' '.join(command))
+            try:
+                tarproc = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+            except FileNotFoundError:
+                # no native tar binary - buffer the plaintext to a file and
+                # fall back to the slower pure-Python extraction
+                real_inp_fn = os.path.join(out_path, f"{inp_basename}.decrypted{modl_fileext}")
+                with open(real_inp_fn, 'wb') as decfh:
+                    decfh.write(head)
+                    for plain in plain_chunks:
+                        decfh.write(plain)
+                with tarfile.open(real_inp_fn) as tarfh:
+                    tar_extractall_overwrite(tarfh, modules_path1)
+                return
+            with tarproc:
+                try:
+                    tarproc.stdin.write(head)
+                    for plain in plain_chunks:
+                        tarproc.stdin.write(plain)
+                    tarproc.stdin.close()
+                except BrokenPipeError:
+                    pass # tar died mid-stream; the exit status assert reports it
+                assert tarproc.wait() == 0, "Extraction failed for module file: {:s}".format(modl_inp_fn)
+            return
+        if arch_format != 'zip':
+            if not ignore_unknown_format:
+                assert False, "Unrecognized archive format of module file: {:s}".format(modl_inp_fn)
+            LOGGER.warning("Unrecognized archive format, module skipped: {:s}".format(modl_inp_fn))
+            return
+        # zip requires seekable input - buffer the plaintext to a file
+        real_inp_fn = os.path.join(out_path, f"{inp_basename}.decrypted{modl_fileext}")
+        LOGGER.info("Decrypting {:s} to {:s}".format(modl_inp_fn, real_inp_fn))
+        with open(real_inp_fn, 'wb') as decfh:
+            decfh.write(head)
+            for plain in plain_chunks:
+                decfh.write(plain)
+    else:
+        real_inp_fn = modl_inp_fn
+
+    with open(real_inp_fn, 'rb') as archfh:
+        arch_format = detect_archive_format(archfh.read(512))
+
+    if arch_format in ('tar', 'tgz'):
+        command = ["tar", "-xzf" if arch_format == 'tgz' else "-xf", real_inp_fn, "-C", modules_path1, "--overwrite"]
+        if LOGGER.isEnabledFor(logging.INFO):
+            LOGGER.info(' '.join(command))
+        try:
+            # quiet tools print nothing on success - detach them from the
+            # pytest capture pipes; stderr stays visible for diagnostics
+            subprocess.run(command, check=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        except FileNotFoundError:
+            # no native tar binary - fall back to the slower pure-Python extraction
+            with tarfile.open(real_inp_fn) as tarfh:
+                tar_extractall_overwrite(tarfh, modules_path1)
+    elif arch_format == 'zip':
+        command = ["unzip", "-q", "-o", "-d", modules_path1, real_inp_fn]
+        if LOGGER.isEnabledFor(logging.INFO):
+            LOGGER.info(' '.join(command))
+        try:
+            # quiet tools print nothing on success - detach them from the
+            # pytest capture pipes; stderr stays visible for diagnostics
+            subprocess.run(command, check=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        except FileNotFoundError:
+            # no native unzip binary - fall back to the slower pure-Python extraction
+            with zipfile.ZipFile(real_inp_fn) as zipfh:
+                zipfh.extractall(modules_path1)
+    else:
+        if not ignore_unknown_format:
+            assert False, "Unrecognized archive format of module file: {:s}".format(modl_inp_fn)
+        LOGGER.warning("Unrecognized archive format, module skipped: {:s}".format(modl_inp_fn))
+    pass
+
+
+def find_module_files(modl_inp_dir, modl_suffixes):
+    """ Walk the directory tree once and select module files by name suffix.
+
+        Replaces one glob per suffix pattern, each of which re-walked the
+        whole tree; the directory scan also confirms entry types, so no
+        separate isfile() filter is needed.
+    """
+    suffixes = tuple(s.lower() for s in modl_suffixes)
+    modl_filenames = []
+    for root, dirs, files in os.walk(modl_inp_dir):
+        relpath = os.path.relpath(root, modl_inp_dir)
+        if relpath == '.':
+            continue # module files live one directory level below
+        if os.sep in relpath:
+            dirs.clear() # do not descend beyond the single allowed level
+            continue
+        for f in files:
+            if f.lower().endswith(suffixes):
+                modl_filenames.append(os.path.join(root, f))
+    return modl_filenames
+
+
+# Input directories, module suffixes and exclusions per test; the
+# pytest_generate_tests hook below expands each test over individual files
+_BIN_ARCHIVES_TESTS = {
+    'test_bin_archives_xv4_extract': (
+        (
+            'out/gl300abc-radio_control',
+            'out/m600-matrice_600_hexacopter',
+            'out/osmo-handheld_camera',
+            'out/p3s-phantom_3_adv_quadcopter',
+            'out/p3x-phantom_3_pro_quadcopter',
+            'out/wm610-t600_inspire_1_x3_quadcopter',
+        ), (
+            "_m0100.bin", "_m0101.bin", "_m0800.bin", "_m0801.bin", "_m1300.bin",
+        ), _EXCLUDE_XV4, False,
+    ),
+    'test_bin_archives_imah_v1_extract': (
+        (
+            'out/wm100-spark',
+            'out/wm220-mavic',
+            'out/wm330-phantom_4_std',
+            'out/wm620-inspire_2',
+        ), (
+            "_0100.bin", "_0101.bin", "_0801.bin", "_0802.bin",
+            "_0805.bin", "_0905.bin", "_1301.bin",
+        ), _EXCLUDE_V1, True,
+    ),
+    'test_bin_archives_imah_v2_extract': (
+        (
+            'out/wm160-mavic_mini',
+            'out/wm161-mini_2',
+            'out/wm230-mavic_air',
+            'out/wm240-mavic_2',
+            'out/wm245-mavic_2_enterpr',
+            'out/wm260-mavic_3',
+        ), (
+            "_0100.bin", "_0101.bin", "_0801.bin", "_0802.bin",
+            "_0805.bin", "_0905.bin", "_1301.bin", "_2403.bin",
+        ), _EXCLUDE_V2, True,
+    ),
+}
+
+
+def pytest_generate_tests(metafunc):
+    """ Parametrize the tests below over individual module files.
+
+        One pytest item per file, instead of a loop within a per-directory
+        item, lets `pytest -n auto` (xdist) schedule every extraction on a
+        separate worker.
+    """
+    if metafunc.definition.originalname not in _BIN_ARCHIVES_TESTS:
+        return
+    inp_dirs, suffixes, excludes, check_encrypted = _BIN_ARCHIVES_TESTS[metafunc.definition.originalname]
+    modl_inp_filenames = []
+    for modl_inp_dir in inp_dirs:
+        modl_inp_filenames += find_module_files(modl_inp_dir, suffixes)
+    # Filter out direct ARM binaries and modules left encrypted, in one pass
+    modl_inp_filenames = [fn for fn in modl_inp_filenames
+        if not any(r.match(fn) for r in excludes)
+        and not (check_encrypted and is_module_unsigned_encrypted(fn))]
+    metafunc.parametrize("modl_inp_fn", modl_inp_filenames)
+
+
+def test_bin_archives_xv4_extract(modl_inp_fn):
+    """ Test if known archives are extracting correctly, and prepare data for tests which use the extracted files.
+    """
+    case_bin_archive_extract(modl_inp_fn)
+    pass
+
+
+def test_bin_archives_imah_v1_extract(modl_inp_fn):
+    """ Test if known archives are extracting correctly, and prepare data for tests which use the extracted files.
+    """
+    case_bin_archive_extract(modl_inp_fn)
+    pass
+
+
+def test_bin_archives_imah_v2_extract(modl_inp_fn):
+    """ Test if known archives are extracting correctly, and prepare data for tests which use the extracted files.
+    """
+    case_bin_archive_extract(modl_inp_fn)
+    pass